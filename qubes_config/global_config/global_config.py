@@ -207,17 +207,21 @@ class GlobalConfig(Gtk.Application):
         self.perform_setup()
         assert self.main_window
         self.main_window.show()
-        # resize to screen size
-        if self.main_window.get_allocated_width() > \
-                self.main_window.get_screen().get_width():
-            width = int(self.main_window.get_screen().get_width() * 0.9)
+        # resize to the size of the monitor the window is on;
+        # Gdk.Screen.get_width/get_height are deprecated and return the
+        # bounding box of all monitors, oversizing on multi-monitor setups
+        display = self.main_window.get_display()
+        monitor = display.get_monitor_at_window(self.main_window.get_window())
+        if monitor is None:
+            monitor = display.get_monitor(0)
+        geometry = monitor.get_geometry()
+        if self.main_window.get_allocated_width() > geometry.width:
+            width = int(geometry.width * 0.9)
         else:
             # try to have at least 1100 pixels
-            width = min(int(self.main_window.get_screen().get_width() * 0.9),
-                        1100)
-        if self.main_window.get_allocated_height() > \
-                self.main_window.get_screen().get_height() * 0.9:
-            height = int(self.main_window.get_screen().get_height() * 0.9)
+            width = min(int(geometry.width * 0.9), 1100)
+        if self.main_window.get_allocated_height() > geometry.height * 0.9:
+            height = int(geometry.height * 0.9)
         else:
             height = self.main_window.get_allocated_height()
         self.main_window.resize(width, height)
@@ -250,12 +250,21 @@ def appviewer_lock():
         os.close(fd)
 
 
+def _atomic_write(path: str, data: bytes, mode: int = 0o644):
+    """Write file contents with a single write syscall"""
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+    try:
+        os.write(fd, data)
+    finally:
+        os.close(fd)
+
+
 def copy_to_global_clipboard(text: str):
     """Copy provided text to global clipboard"""
+    # pre-format all payloads so the lock is held only for the writes
+    data = text.encode('utf-8')
+    timestamp = str(Gtk.get_current_event_time()).encode('ascii')
     with appviewer_lock():
-        with open(DATA, "w", encoding='utf-8') as contents:
-            contents.write(text)
-        with open(FROM, "w", encoding='ascii') as source:
-            source.write("dom0")
-        with open(XEVENT, "w", encoding='ascii') as timestamp:
-            timestamp.write(str(Gtk.get_current_event_time()))
+        _atomic_write(DATA, data)
+        _atomic_write(FROM, b"dom0")
+        _atomic_write(XEVENT, timestamp)
@@ -19,7 +19,6 @@
 # with this program; if not, see <http://www.gnu.org/licenses/>.
 """Qubes helper functions"""
 import subprocess
-import threading
 import qubesadmin
 import qubesadmin.exc
 import qubesadmin.vm
@@ -109,16 +108,18 @@ def compare_rule_lists(rule_list_1: List[Rule],
     return True
 
 def _open_url_in_dvm(url, default_dvm: qubesadmin.vm.QubesVM):
-    subprocess.run(
+    # fire-and-forget: don't wait for the DispVM to start and the service
+    # to finish; start_new_session detaches qvm-run so it survives us
+    proc = subprocess.Popen(
         ['qvm-run', '-p', '--service', f'--dispvm={default_dvm}',
-         'qubes.OpenURL'], input=url.encode(), check=False,
-        stderr=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+         'qubes.OpenURL'], stdin=subprocess.PIPE,
+        stderr=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+        start_new_session=True)
+    proc.stdin.write(url.encode())
+    proc.stdin.close()
 
 def open_url_in_disposable(url: str, qapp: qubesadmin.Qubes):
     """Open provided url in disposable qube based on default disposable
     template"""
     default_dvm = qapp.default_dispvm
-    open_thread = threading.Thread(group=None,
-                                   target=_open_url_in_dvm,
-                                   args=[url, default_dvm])
-    open_thread.start()
+    _open_url_in_dvm(url, default_dvm)
@@ -23,12 +23,15 @@
 # pylint: disable=import-error
 
 ''' Sends notifications via Gio.Notification when something is Copy-Pasted
-via Qubes RPC '''
+via Qubes RPC
+
+Readers of the clipboard files take the appviewer lock shared, writers
+take it exclusive, so notification handlers do not serialize against
+each other or block the gui daemon longer than necessary. '''
 # pylint: disable=invalid-name,wrong-import-position
 
 import asyncio
 import contextlib
-import math
 import os
 import fcntl
 import qubesadmin
@@ -39,7 +42,6 @@ gi.require_version('Gtk', '3.0')  # isort:skip
 from gi.repository import Gtk, Gio, Gdk  # isort:skip
 
 import gbulb
-import pyinotify
 
 import gettext
 t = gettext.translation("desktop-linux-manager", fallback=True)
@@ -56,34 +58,59 @@ XEVENT = "/var/run/qubes/qubes-clipboard.bin.xevent"
 APPVIEWER_LOCK = "/var/run/qubes/appviewer.lock"
 COPY_FEATURE = 'gui-default-secure-copy-sequence'
 PASTE_FEATURE = 'gui-default-secure-paste-sequence'
+UNITS = ('B', 'KiB', 'MiB', 'GiB')
 
 
 @contextlib.contextmanager
-def appviewer_lock():
+def appviewer_lock(shared: bool = False):
     fd = os.open(APPVIEWER_LOCK, os.O_RDWR | os.O_CREAT, 0o0666)
     try:
-        fcntl.flock(fd, fcntl.LOCK_EX)
+        fcntl.flock(fd, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
         yield
     finally:
         fcntl.flock(fd, fcntl.LOCK_UN)
         os.close(fd)
 
-class EventHandler(pyinotify.ProcessEvent):
-    # pylint: disable=arguments-differ
-    def my_init(self, loop=None, gtk_app=None):
-        '''  This method is called from ProcessEvent.__init__(). '''
+
+def appviewer_lock_shared():
+    ''' Shared (read-only) variant of appviewer_lock '''
+    return appviewer_lock(shared=True)
+
+
+def _read_vmname() -> str:
+    ''' Read the source VM name from the FROM file with a single
+    unbuffered read '''
+    fd = os.open(FROM, os.O_RDONLY)
+    try:
+        buf = os.read(fd, 256)
+    finally:
+        os.close(fd)
+    return buf.split(b'\n', 1)[0].decode('ascii')
+
+
+def _atomic_write(path, data: bytes, mode=0o644):
+    ''' Write file contents with a single write syscall '''
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+    try:
+        os.write(fd, data)
+    finally:
+        os.close(fd)
+
+
+class EventHandler:
+    def __init__(self, loop=None, gtk_app=None):
         self.gtk_app = gtk_app
         self.loop = loop if loop else asyncio.get_event_loop()
+        self._last_mtime = 0
 
-    def _copy(self, vmname: str = None):
+    def _copy(self, vmname: str = None, file_size: int = None):
         ''' Sends Copy notification via Gio.Notification
         '''
         if vmname is None:
-            with appviewer_lock():
-                with open(FROM, 'r', encoding='ascii') as vm_from_file:
-                    vmname = vm_from_file.readline().strip('\n')
+            with appviewer_lock_shared():
+                vmname = _read_vmname()
 
-        size = clipboard_formatted_size()
+        size = clipboard_formatted_size(file_size)
 
         body = _("Clipboard contents fetched from qube: <b>'{vmname}'</b>\n"
                  "Copied <b>{size}</b> to the global clipboard.\n"
@@ -100,56 +127,66 @@ class EventHandler(pyinotify.ProcessEvent):
                  "<small>Paste normally in qube (e.g. Ctrl+V).</small>")
         self.gtk_app.update_clipboard_contents(message=body)
 
-    def process_IN_CLOSE_WRITE(self, _unused):
+    def on_close_write(self):
         ''' Reacts to modifications of the FROM file '''
-        with appviewer_lock():
-            with open(FROM, 'r', encoding='ascii') as vm_from_file:
-                vmname = vm_from_file.readline().strip('\n')
+        # one stat of DATA serves both the duplicate-event check and the
+        # size shown in the notification
+        try:
+            data_stat = os.stat(DATA)
+        except OSError:
+            data_stat = None
+
+        # writers may close FROM several times per clipboard operation;
+        # skip duplicate events for unchanged clipboard contents
+        mtime = data_stat.st_mtime_ns if data_stat else 0
+        if mtime and mtime == self._last_mtime:
+            return
+        self._last_mtime = mtime
+
+        with appviewer_lock_shared():
+            vmname = _read_vmname()
         if vmname == "":
             self._paste()
         else:
-            self._copy(vmname=vmname)
+            self._copy(vmname=vmname,
+                       file_size=data_stat.st_size if data_stat else None)
 
-    def process_IN_MOVE_SELF(self, _unused):
-        ''' Stop loop if file is moved '''
+    def on_gone(self):
+        ''' Stop loop if the FROM file is moved or deleted '''
         self.loop.stop()
 
-    def process_IN_DELETE(self, _unused):
-        ''' Stop loop if file is deleted '''
-        self.loop.stop()
-
-    def process_IN_CREATE(self, event):
-        if event.pathname == FROM:
-            self._copy()
-            self.gtk_app.setup_watcher()
-
+    def on_created(self):
+        ''' Reacts to the FROM file appearing '''
+        self._copy()
+        self.gtk_app.setup_watcher()
 
-def clipboard_formatted_size() -> str:
-    units = ['B', 'KiB', 'MiB', 'GiB']
 
-    try:
-        file_size = os.path.getsize(DATA)
-    except OSError:
-        return _('? bytes')
+def clipboard_formatted_size(file_size: int = None) -> str:
+    if file_size is None:
+        try:
+            file_size = os.path.getsize(DATA)
+        except OSError:
+            return _('? bytes')
     if file_size == 1:
         formatted_bytes = _('1 byte')
     else:
         formatted_bytes = str(file_size) + _(' bytes')
 
     if file_size > 0:
-        magnitude = min(
-            int(math.log(file_size) / math.log(2) * 0.1), len(units) - 1)
+        # (bit_length() - 1) // 10 == floor(log2(size)) // 10, computed
+        # without floating point
+        magnitude = min((file_size.bit_length() - 1) // 10, len(UNITS) - 1)
         if magnitude > 0:
             # pylint: disable=consider-using-f-string
             return '%s (%.1f %s)' % (formatted_bytes,
-                                     file_size / (2.0**(10 * magnitude)),
-                                     units[magnitude])
+                                     file_size / (1 << (10 * magnitude)),
+                                     UNITS[magnitude])
     # pylint: disable=consider-using-f-string
     return '%s' % (formatted_bytes)
 
 
 class NotificationApp(Gtk.Application):
-    def __init__(self, wm, qapp, dispatcher, **properties):
+    def __init__(self, qapp, dispatcher, **properties):
         super().__init__(**properties)
         self.set_application_id("org.qubes.qui.clipboard")
         self.register()  # register Gtk Application
@@ -165,20 +202,26 @@ class NotificationApp(Gtk.Application):
               ' state of the global clipboard.'))
         self.icon.connect('button-press-event', self.show_menu)
 
-        self.menu = Gtk.Menu()
+        self.menu = None
         self.clipboard_label = Gtk.Label(xalign=0)
+        self.clipboard_label.set_markup(_(
+            "<i>Global clipboard is empty</i>"))
+        self.help_label = Gtk.Label(xalign=0)
 
         self.copy_shortcut = None
         self.paste_shortcut = None
+        self._menu_dirty = True
         self.setup_ui()
 
-        self.wm = wm
-        self.temporary_watch = None
+        self.handler = None  # set in main() once the EventHandler exists
+        self.file_monitor = None
+        self.dir_monitor = None
 
         if not os.path.exists(FROM):
-            # pylint: disable=no-member
-            self.temporary_watch = \
-                self.wm.add_watch(FROM_DIR, pyinotify.IN_CREATE, rec=False)
+            # watch the directory until the FROM file appears
+            self.dir_monitor = Gio.File.new_for_path(
+                FROM_DIR).monitor_directory(Gio.FileMonitorFlags.NONE, None)
+            self.dir_monitor.connect('changed', self._on_dir_changed)
         else:
             self.setup_watcher()
 
@@ -189,13 +232,36 @@ class NotificationApp(Gtk.Application):
                                         self.setup_ui)
 
     def setup_watcher(self):
-        if self.temporary_watch:
-            for wd in self.temporary_watch.values():
-                self.wm.rm_watch(wd)
-        mask = pyinotify.ALL_EVENTS
-        self.wm.add_watch(FROM, mask)
+        if self.dir_monitor is not None:
+            self.dir_monitor.cancel()
+            self.dir_monitor = None
+        self.file_monitor = Gio.File.new_for_path(FROM).monitor_file(
+            Gio.FileMonitorFlags.NONE, None)
+        self.file_monitor.connect('changed', self._on_from_changed)
+
+    def _on_from_changed(self, _monitor, _file, _other_file, event_type):
+        if self.handler is None:
+            return
+        if event_type == Gio.FileMonitorEvent.CHANGES_DONE_HINT:
+            # the write burst has settled; the inotify equivalent of
+            # IN_CLOSE_WRITE
+            self.handler.on_close_write()
+        elif event_type == Gio.FileMonitorEvent.DELETED:
+            # renames are also delivered as DELETED, since the monitor
+            # is not created with WATCH_MOVES
+            self.handler.on_gone()
+
+    def _on_dir_changed(self, _monitor, changed_file, _other_file,
+                        event_type):
+        if self.handler is None:
+            return
+        if event_type == Gio.FileMonitorEvent.CREATED and \
+                changed_file.get_path() == FROM:
+            self.handler.on_created()
 
     def show_menu(self, _unused, event):
+        if self._menu_dirty:
+            self._refresh_menu()
         self.menu.show_all()
         self.menu.popup(None,  # parent_menu_shell
                         None,  # parent_menu_item
@@ -221,11 +287,20 @@ class NotificationApp(Gtk.Application):
             self.send_notify(message)
 
     def setup_ui(self, *_args, **_kwargs):
-        self.copy_shortcut = self._prettify_shortcut(self.vm.features.get(
+        # fetch the features in one go instead of one Admin API
+        # round-trip per feature
+        features = dict(self.vm.features)
+        self.copy_shortcut = self._prettify_shortcut(features.get(
             COPY_FEATURE, 'Ctrl-Shift-C'))
-        self.paste_shortcut = self._prettify_shortcut(self.vm.features.get(
+        self.paste_shortcut = self._prettify_shortcut(features.get(
             PASTE_FEATURE, 'Ctrl-Shift-V'))
 
+        # the shortcuts above are needed right away for notification
+        # bodies, but rebuilding the menu can wait until it is opened
+        self._menu_dirty = True
+
+    def _build_menu(self):
+        ''' Build the static menu skeleton; runs only once '''
         self.menu = Gtk.Menu()
 
         title_label = Gtk.Label(xalign=0)
@@ -238,20 +313,14 @@ class NotificationApp(Gtk.Application):
         clipboard_content_item = Gtk.MenuItem()
         clipboard_content_item.set_sensitive(False)
         clipboard_content_item.add(self.clipboard_label)
-        self.update_clipboard_contents()
         self.menu.append(clipboard_content_item)
 
         self.menu.append(Gtk.SeparatorMenuItem())
 
-        help_label = Gtk.Label(xalign=0)
-        help_label.set_markup(
-            _("<i>Use <b>{copy}</b> to copy and "
-              "<b>{paste}</b> to paste.</i>").format(
-                copy=self.copy_shortcut, paste=self.paste_shortcut))
         help_item = Gtk.MenuItem()
         help_item.set_margin_left(10)
         help_item.set_sensitive(False)
-        help_item.add(help_label)
+        help_item.add(self.help_label)
         self.menu.append(help_item)
 
         self.menu.append(Gtk.SeparatorMenuItem())
@@ -260,6 +329,16 @@ class NotificationApp(Gtk.Application):
         dom0_item.connect('activate', self.copy_dom0_clipboard)
         self.menu.append(dom0_item)
 
+    def _refresh_menu(self):
+        ''' Update the dynamic labels, reusing the menu skeleton '''
+        if self.menu is None:
+            self._build_menu()
+        self.help_label.set_markup(
+            _("<i>Use <b>{copy}</b> to copy and "
+              "<b>{paste}</b> to paste.</i>").format(
+                copy=self.copy_shortcut, paste=self.paste_shortcut))
+        self._menu_dirty = False
+
     def copy_dom0_clipboard(self, *_args, **_kwargs):
         clipboard = Gtk.Clipboard.get(Gdk.SELECTION_CLIPBOARD)
         text = clipboard.wait_for_text()
@@ -268,16 +347,18 @@ class NotificationApp(Gtk.Application):
             self.send_notify(_("Dom0 clipboard is empty!"))
             return
 
+        # pre-format all payloads so the lock is held only for the writes
+        data = text.encode('utf-8')
+        timestamp = str(Gtk.get_current_event_time()).encode('ascii')
+
         try:
             with appviewer_lock():
-                with open(DATA, "w", encoding='utf-8') as contents:
-                    contents.write(text)
-                with open(FROM, "w", encoding='ascii') as source:
-                    source.write("dom0")
-                with open(XEVENT, "w", encoding='ascii') as timestamp:
-                    timestamp.write(str(Gtk.get_current_event_time()))
-        except Exception:  # pylint: disable=broad-except
-            self.send_notify(_("Error while accessing global clipboard!"))
+                _atomic_write(DATA, data)
+                _atomic_write(FROM, b"dom0")
+                _atomic_write(XEVENT, timestamp)
+        except OSError as ex:
+            self.send_notify(
+                _("Error while accessing global clipboard: {}").format(ex))
 
     def send_notify(self, body):
         # pylint: disable=attribute-defined-outside-init
@@ -304,15 +385,13 @@ class NotificationApp(Gtk.Application):
 
 def main():
     loop = asyncio.get_event_loop()
-    wm = pyinotify.WatchManager()
 
     qubes_app = qubesadmin.Qubes()
+    qubes_app.cache_enabled = True
     dispatcher = qubesadmin.events.EventsDispatcher(qubes_app)
 
-    gtk_app = NotificationApp(wm, qubes_app, dispatcher)
-
-    handler = EventHandler(loop=loop, gtk_app=gtk_app)
-    pyinotify.AsyncioNotifier(wm, loop, default_proc_fun=handler)
+    gtk_app = NotificationApp(qubes_app, dispatcher)
+    gtk_app.handler = EventHandler(loop=loop, gtk_app=gtk_app)
 
     return run_asyncio_and_show_errors(loop, [asyncio.ensure_future(
         dispatcher.listen_for_events())], _("Qubes Clipboard Widget"))
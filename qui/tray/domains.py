@@ -53,13 +53,14 @@ class IconCache:
             'restart': 'edit-redo'
         }
         self.icons = {}
+        self.icon_theme = Gtk.IconTheme.get_default()
 
     def get_icon(self, icon_name):
         if icon_name in self.icons:
             icon = self.icons[icon_name]
         else:
             try:
-                icon = Gtk.IconTheme.get_default().load_icon(
+                icon = self.icon_theme.load_icon(
                     self.icon_files[icon_name], 16, 0)
                 self.icons[icon_name] = icon
             except (TypeError, GLib.Error):